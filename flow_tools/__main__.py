@@ -6,15 +6,18 @@ Command line client to automate parts of our agile workflow.
 
 from __future__ import print_function
 import argparse
+import concurrent.futures
 import datetime
-import io
-import inspect
+import importlib.machinery
+import importlib.util
 import logging
 import os
 import re
 import sys
 import textwrap
 
+import jira
+
 import flow_tools
 from flow_tools import orm
 from flow_tools import gerrit_util
@@ -26,6 +29,7 @@ from flow_tools import jira_util
 class Configuration(object):
   def __init__(self, db_url=None, jira=None, gerrit=None, gerrit_jira=None,
                git=None, **extra):
+    # pylint: disable=redefined-outer-name
     self.db_url = db_url
     self.jira = jira_util.Configuration(**jira)
     self.gerrit = gerrit_util.Configuration(**gerrit)
@@ -37,6 +41,17 @@ class Configuration(object):
         continue
       logging.warn("Unused config option: %s", key)
 
+    self._jira_client = None
+
+  @property
+  def jira_client(self):
+    """
+    The jira rest client, which is created the first time it is requested.
+    """
+    if self._jira_client is None:
+      self._jira_client = jira_util.get_jira(**self.jira.auth)
+    return self._jira_client
+
 
 def print_header(header, char=None):
   """
@@ -45,16 +60,138 @@ def print_header(header, char=None):
   if char is None:
     char = '='
 
-  sys.stdout.write(header)
-  sys.stdout.write('\n')
-  sys.stdout.write(char*len(header))
-  sys.stdout.write('\n')
+  sys.stdout.write('{}\n{}\n'.format(header, char*len(header)))
+
+
+def write_lines(lines):
+  """
+  Write each string in `lines` to stdout, newline terminated, using a single
+  write.
+  """
+  sys.stdout.write(''.join(line + '\n' for line in lines))
+
+
+# Maps (issue_key, fields) to issue objects already fetched from jira
+_ISSUE_CACHE = {}
+
+
+def cached_issue(jira_client, issue_key, fields):
+  """
+  Return the issue object for `issue_key` with the requested `fields`,
+  fetching it from jira only the first time it is requested.
+  """
+  cache_key = (issue_key, fields)
+  issue_obj = _ISSUE_CACHE.get(cache_key, None)
+  if issue_obj is None:
+    issue_obj = jira_util.get_issue(jira_client, issue_key, fields)
+    _ISSUE_CACHE[cache_key] = issue_obj
+  return issue_obj
+
+
+def fetch_issues(jira_client, issue_keys, fields, max_workers=10):
+  """
+  Fetch the issues in `issue_keys` concurrently. Return a dictionary mapping
+  each issue key to its issue object, or to None if jira failed to return the
+  issue.
+  """
+  def fetch_issue(issue_key):
+    try:
+      return cached_issue(jira_client, issue_key, fields)
+    except jira.JIRAError:
+      return None
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    return dict(zip(issue_keys, executor.map(fetch_issue, issue_keys)))
+
+
+def format_issue_summaries(jira_client, config, issues, url=False):
+  """
+  Return a list of output lines with the summary of each issue in `issues`.
+  If `url` is true, each issue is given by its url followed by an indented
+  summary.
+  """
+  if url:
+    wrapper = textwrap.TextWrapper(width=80, initial_indent=' '*4,
+                                   subsequent_indent=' '*4)
+  else:
+    wrapper = textwrap.TextWrapper(width=80, initial_indent='',
+                                   subsequent_indent=' '*11)
+
+  lines = []
+  issue_objs = fetch_issues(jira_client, issues, 'summary')
+  for issue in issues:
+    issue_obj = issue_objs[issue]
+    if issue_obj is None:
+      lines.append('{}: N/A'.format(issue))
+      continue
+
+    if url:
+      lines.append('{}/browse/{}'.format(config.jira.auth['url'], issue))
+      lines.append(wrapper.fill(issue_obj.fields.summary))
+    else:
+      lines.append(wrapper.fill('{}: {}'
+                                .format(issue, issue_obj.fields.summary)))
+
+  return lines
+
+
+def get_mtime(path):
+  """
+  Return the modification time of `path`, or None if it doesn't exist.
+  """
+  try:
+    return os.path.getmtime(path)
+  except OSError:
+    return None
+
+
+# Maps a repository and the state of its tags to the list of release pairs
+_RELEASE_PAIRS_CACHE = {}
+
+
+def get_release_pairs(repo_path, config, release=None):
+  """
+  Return a list of (from_tag, to_tag) tuples for each pair of consecutive
+  releases in the repository. The list is recomputed only if the tags of the
+  repository have changed since the last call.
+
+  If `release` is not None, return only the pair ending at `release`, found
+  from the ancestry of that release without listing every tag.
+  """
+  if release is not None:
+    pair = git_util.get_release_pair(repo_path, config, release)
+    return [] if pair is None else [pair]
+
+  git_dir = os.path.join(repo_path, '.git')
+  cache_key = (os.path.abspath(repo_path), config.git.release_pattern,
+               get_mtime(os.path.join(git_dir, 'refs', 'tags')),
+               get_mtime(os.path.join(git_dir, 'packed-refs')))
+
+  pairs = _RELEASE_PAIRS_CACHE.get(cache_key, None)
+  if pairs is None:
+    releases = git_util.get_releases(repo_path, config)
+    pairs = list(zip(releases[0:-1], releases[1:]))
+    _RELEASE_PAIRS_CACHE[cache_key] = pairs
+  return pairs
+
 
 def class_to_cmd(name):
   intermediate = re.sub('(.)([A-Z][a-z]+)', r'\1-\2', name)
   return re.sub('([a-z0-9])([A-Z])', r'\1-\2', intermediate).lower()
 
 
+# Maps command names to the Command subclass implementing that command
+COMMANDS = {}
+
+
+def register(cmd_class):
+  """
+  Class decorator adding a Command subclass to the registry of commands.
+  """
+  COMMANDS[cmd_class.get_cmd()] = cmd_class
+  return cmd_class
+
+
 class Command(object):
   """
   Base class making it a little easier to set up a complex argparse tree by
@@ -72,9 +209,13 @@ class Command(object):
   def get_cmd(cls):
     """
     Return a string command name formulated by de-camael-casing the class
-    name.
+    name. The name is computed once and stored on the class.
     """
-    return class_to_cmd(cls.__name__)
+    # Check the class dictionary rather than using getattr so that a
+    # subclass doesn't inherit the command name of its parent
+    if '_cmd_name' not in cls.__dict__:
+      cls._cmd_name = class_to_cmd(cls.__name__)
+    return cls._cmd_name
 
   @classmethod
   def add_parser(cls, subparsers):
@@ -95,6 +236,7 @@ class Command(object):
                        .format(getattr(cls, '__name__', '??')))
 
 
+@register
 class AddMentionsToWatchers(Command):
   """Get a list of all mentioned users in the issue comments and description,
      and add any to the watcher list that are not already watchers."""
@@ -105,13 +247,17 @@ class AddMentionsToWatchers(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    jira_client = jira_util.get_jira(**config.jira.auth)
+    jira_client = config.jira_client
 
     for issue_key in args.issue_keys:
       issue = jira_client.issue(issue_key)
-      jira_util.add_mentions_to_watchers(jira_client, issue)
+      # The issue already carries its comments, so don't fetch them again
+      comment_field = getattr(issue.fields, 'comment', None)
+      comments = None if comment_field is None else comment_field.comments
+      jira_util.add_mentions_to_watchers(jira_client, issue, comments)
 
 
+@register
 class CloseIssuesMerged(Command):
   """
   Walk the list of merges on master for the given user. Look for tags in
@@ -124,12 +270,12 @@ class CloseIssuesMerged(Command):
   def setup_parser(parser):
     parser.add_argument('-r', '--repo-path', default=os.getcwd(),
                         help='Path to the repository')
-    parser.add_argument('-m', '--max-commits', default=100,
+    parser.add_argument('-m', '--max-commits', type=int, default=100,
                         help='Don\'t inspect more than this many commits')
 
   @classmethod
   def run_args(cls, config, args):
-    jira_client = jira_util.get_jira(**config.jira.auth)
+    jira_client = config.jira_client
     tag_map = config.gerrit_jira.tag_map
     integrations.close_issues_with_merged_resolutions(
         jira_client, args.repo_path, tag_map, branch='master',
@@ -138,6 +284,25 @@ class CloseIssuesMerged(Command):
 GERRIT_TIME_FMT = "%Y-%m-%d %H:%M:%S"
 
 
+def positive_int(value):
+  """
+  Argument type for options which must be a positive integer
+  """
+  try:
+    number = int(value)
+  except ValueError:
+    number = 0
+  if number < 1:
+    raise argparse.ArgumentTypeError(
+        '{} is not a positive integer'.format(value))
+  return number
+
+
+# Persistent cache of metadata parsed from gerrit commit messages
+MESSAGE_META_CACHE_PATH = os.path.expanduser('~/.flowtools/cache/msgmeta.pkl')
+
+
+@register
 class UpdateJiraFromGerrit(Command):
   """
   Monitor changes on gerrit for tags indicating associated issues that are
@@ -161,21 +326,33 @@ class UpdateJiraFromGerrit(Command):
     parser.add_argument('-d', '--dry-run', action='store_true',
                         help="do all the work except don't actually update"
                              " jira.")
+    parser.add_argument('-w', '--workers', type=positive_int, default=8,
+                        help='number of concurrent gerrit and jira requests,'
+                             ' use 1 to process changes serially')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='process changes again even if their current'
+                             ' revision was already processed')
 
   @classmethod
   def run_args(cls, config, args):
-    jira_client = jira_util.get_jira(**config.jira.auth)
+    jira_client = config.jira_client
     gerrit_client = gerrit_util.get_gerrit(**config.gerrit.rest)
     session_factory = orm.init_sql(config.db_url)
 
     nominal_flow = config.jira.nominal_flow
     tag_map = config.gerrit_jira.tag_map
 
-    integrations.update_issues_from_review(
-        gerrit_client, jira_client, session_factory(), args.project,
-        args.start_time, args.end_time, args.dry_run, nominal_flow, tag_map)
+    gerrit_util.load_message_meta_cache(MESSAGE_META_CACHE_PATH)
+    try:
+      integrations.update_issues_from_review(
+          gerrit_client, jira_client, session_factory(), args.project,
+          args.start_time, args.end_time, args.dry_run, nominal_flow, tag_map,
+          max_workers=args.workers, force=args.force)
+    finally:
+      gerrit_util.save_message_meta_cache(MESSAGE_META_CACHE_PATH)
 
 
+@register
 class IncrementJiraFromGerrit(Command):
   """
   Monitor changes on gerrit for tags indicating associated issues that are
@@ -194,10 +371,16 @@ class IncrementJiraFromGerrit(Command):
     parser.add_argument('-d', '--dry-run', action='store_true',
                         help="do all the work except don't actually update"
                              " jira.")
+    parser.add_argument('-w', '--workers', type=positive_int, default=8,
+                        help='number of concurrent gerrit and jira requests,'
+                             ' use 1 to process changes serially')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='process changes again even if their current'
+                             ' revision was already processed')
 
   @classmethod
   def run_args(cls, config, args):
-    jira_client = jira_util.get_jira(**config.jira.auth)
+    jira_client = config.jira_client
     gerrit_client = gerrit_util.get_gerrit(**config.gerrit.rest)
     session_factory = orm.init_sql(config.db_url)
 
@@ -223,21 +406,25 @@ class IncrementJiraFromGerrit(Command):
     record = orm.PollHistory(period_start=start_time, period_end=end_time,
                              status=-1)
 
+    gerrit_util.load_message_meta_cache(MESSAGE_META_CACHE_PATH)
     try:
       integrations.update_issues_from_review(
           gerrit_client, jira_client, sql, args.project,
           start_time.strftime(GERRIT_TIME_FMT),
           end_time.strftime(GERRIT_TIME_FMT),
-          args.dry_run, nominal_flow, tag_map)
+          args.dry_run, nominal_flow, tag_map, max_workers=args.workers,
+          force=args.force)
       record.status = 0
     except:
       raise
     finally:
+      gerrit_util.save_message_meta_cache(MESSAGE_META_CACHE_PATH)
       if not args.dry_run:
         sql.add(record)
         sql.commit()
 
 
+@register
 class PrintReleases(Command):
   """
   Parse tags on the gerrit remote and print a sorted list of version strings,
@@ -250,10 +437,9 @@ class PrintReleases(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    for version in git_util.get_releases(args.repo_path, config):
-      sys.stdout.write(version)
-      sys.stdout.write('\n')
+    write_lines(git_util.get_releases(args.repo_path, config))
 
+@register
 class IssuesInRelease(Command):
   """
   Show a list of issues that were closed in a release. In particular, lookup
@@ -272,44 +458,18 @@ class IssuesInRelease(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    import jira
-    jira_client = jira_util.get_jira(**config.jira.auth)
-    releases = git_util.get_releases(args.repo_path, config)
-    pairs = zip(releases[0:-1], releases[1:])
-    if args.url:
-      wrapper = textwrap.TextWrapper(width=80, initial_indent=' '*4,
-                                     subsequent_indent=' '*4)
-    else:
-      wrapper = textwrap.TextWrapper(width=80, initial_indent='',
-                                     subsequent_indent=' '*11)
-
+    jira_client = config.jira_client
+    pairs = get_release_pairs(args.repo_path, config, args.release)
 
     for from_tag, to_tag in pairs:
-      if args.release is not None and to_tag != args.release:
-        continue
-
       print_header('{} -> {}'.format(from_tag, to_tag))
       issues = git_util.get_issues_closed_in_series(
           args.repo_path, from_tag, to_tag, config.gerrit_jira.tag_map)
-      for issue in issues:
-        try:
-          issue_obj = jira_client.issue(issue, 'summary')
-        except jira.JIRAError:
-          sys.stdout.write('{}: N/A\n'.format(issue))
-          continue
-
-        if args.url:
-          sys.stdout.write('{}/browse/{}\n'
-                           .format(config.jira.auth['url'], issue))
-          sys.stdout.write(wrapper.fill(issue_obj.fields.summary))
-          sys.stdout.write('\n')
-        else:
-          text = wrapper.fill('{}: {}'
-                              .format(issue, issue_obj.fields.summary))
-          sys.stdout.write(text)
-          sys.stdout.write('\n')
+      write_lines(
+          format_issue_summaries(jira_client, config, issues, args.url))
 
 
+@register
 class SetIssuesFixedInRelease(Command):
   """
   For each issue closed in a release, set the "Fixed Release" field of jira
@@ -323,27 +483,29 @@ class SetIssuesFixedInRelease(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    import jira
-    jira_client = jira_util.get_jira(**config.jira.auth)
-    releases = git_util.get_releases(args.repo_path, config)
-    pairs = zip(releases[0:-1], releases[1:])
+    jira_client = config.jira_client
+    pairs = get_release_pairs(args.repo_path, config, args.release)
 
     for from_tag, to_tag in pairs:
-      if args.release is not None and to_tag != args.release:
-        continue
-
       print_header('{} -> {}'.format(from_tag, to_tag))
       issues = git_util.get_issues_closed_in_series(
           args.repo_path, from_tag, to_tag, config.gerrit_jira.tag_map)
+      issue_objs = fetch_issues(jira_client, issues,
+                                config.jira.fixed_release_field)
       for issue in issues:
+        issue_obj = issue_objs[issue]
+        if issue_obj is None:
+          sys.stdout.write('  {}: failed (non-existant?)\n'.format(issue))
+          continue
+
         try:
-          issue_obj = jira_client.issue(issue, config.jira.fixed_release_field)
           issue_obj.update(fields={config.jira.fixed_release_field :to_tag})
           sys.stdout.write('  {}: {}\n'.format(issue, to_tag))
         except jira.JIRAError:
           sys.stdout.write('  {}: failed (non-existant?)\n'.format(issue))
           continue
 
+@register
 class ChangesInRelease(Command):
   """
   Show a list of commit message summaries for each commit in the series between
@@ -358,18 +520,14 @@ class ChangesInRelease(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    releases = git_util.get_releases(args.repo_path, config)
-    pairs = zip(releases[0:-1], releases[1:])
+    pairs = get_release_pairs(args.repo_path, config, args.release)
     for from_tag, to_tag in pairs:
-      if args.release is not None and to_tag != args.release:
-        continue
       print_header('{} -> {}'.format(from_tag, to_tag))
       summaries = git_util.get_release_notes(args.repo_path, from_tag, to_tag)
-      for summary in summaries:
-        sys.stdout.write(summary)
-        sys.stdout.write('\n')
+      write_lines(summaries)
 
 
+@register
 class ReleaseNotes(Command):
   """
   Combines issues-in-release and changes-in-release into a single output
@@ -384,73 +542,41 @@ class ReleaseNotes(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    import jira
-    jira_client = jira_util.get_jira(**config.jira.auth)
-    releases = git_util.get_releases(args.repo_path, config)
-    pairs = zip(releases[0:-1], releases[1:])
-    if args.url:
-      wrapper = textwrap.TextWrapper(width=80, initial_indent=' '*4,
-                                     subsequent_indent=' '*4)
-    else:
-      wrapper = textwrap.TextWrapper(width=80, initial_indent='',
-                                     subsequent_indent=' '*11)
-
+    jira_client = config.jira_client
+    pairs = get_release_pairs(args.repo_path, config, args.release)
 
     for from_tag, to_tag in pairs:
-      if args.release is not None and to_tag != args.release:
-        continue
       print_header('{} -> {}'.format(from_tag, to_tag))
-      sys.stdout.write('\n')
-      issues = git_util.get_issues_closed_in_series(
+      issues, summaries = git_util.walk_release(
           args.repo_path, from_tag, to_tag, config.gerrit_jira.tag_map)
-      summaries = git_util.get_release_notes(args.repo_path, from_tag, to_tag)
-
-      for issue in issues:
-        try:
-          issue_obj = jira_client.issue(issue, 'summary')
-        except jira.JIRAError:
-          sys.stdout.write('{}: N/A\n'.format(issue))
-          continue
-
-        if args.url:
-          sys.stdout.write('{}/browse/{}\n'
-                           .format(config.jira.auth['url'], issue))
-          sys.stdout.write(wrapper.fill(issue_obj.fields.summary))
-          sys.stdout.write('\n')
-        else:
-          text = wrapper.fill('{}: {}'
-                              .format(issue, issue_obj.fields.summary))
-          sys.stdout.write(text)
-          sys.stdout.write('\n')
 
+      lines = ['']
+      lines.extend(
+          format_issue_summaries(jira_client, config, issues, args.url))
       if issues and summaries:
-        sys.stdout.write('\n')
-
-      for summary in summaries:
-        sys.stdout.write(summary)
-        sys.stdout.write('\n')
+        lines.append('')
+      lines.extend(summaries)
+      write_lines(lines)
 
 
 def get_config(config_path):
+  """
+  Load the python configuration file at `config_path` as a module and return
+  a dictionary of its public variables. The file is loaded through the import
+  system so that its compiled bytecode is cached between invocations.
+  """
+  loader = importlib.machinery.SourceFileLoader('_flowtools_config',
+                                                config_path)
+  spec = importlib.util.spec_from_file_location('_flowtools_config',
+                                                config_path, loader=loader)
+  module = importlib.util.module_from_spec(spec)
   try:
-    with io.open(config_path, 'r', encoding='utf-8') as infile:
-      config_dict = {}
-      exec(infile.read(), config_dict)  # pylint: disable=W0122
-      return config_dict
+    loader.exec_module(module)
   except (IOError, OSError):
     return {}
 
-def iter_command_classes():
-  """
-  Return a list of all Command subclasses in this file.
-  """
-
-  for _, cmd_class in globals().iteritems():
-    if (inspect.isclass(cmd_class)
-            # pylint: disable=bad-continuation
-            and issubclass(cmd_class, Command)
-            and cmd_class is not Command):
-      yield cmd_class
+  return {key: value for key, value in vars(module).items()
+          if not key.startswith('_')}
 
 HELP_EPILOG = """
 Subcommands have their own options. Use <command> -h or <command> --help to
@@ -476,8 +602,7 @@ def main(argv=None):
   subparsers = parser.add_subparsers(dest='command', metavar='<command>')
 
 
-  commands = [init() for init in iter_command_classes()]
-  for command in commands:
+  for command in COMMANDS.values():
     command.add_parser(subparsers)
 
   try:
@@ -489,9 +614,11 @@ def main(argv=None):
 
   config = Configuration(**get_config(args.config))
 
-  for command in commands:
-    if args.command == command.get_cmd():
-      return command.run_args(config, args)
+  command = COMMANDS.get(args.command, None)
+  if command is None:
+    parser.print_usage()
+    return 1
+  return command.run_args(config, args)
 
 if __name__ == '__main__':
   sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,17 @@
-import urllib
+import collections
+import concurrent.futures
+import io
+import logging
+import os
+import pickle
+import threading
 
 import pygerrit2.rest
 import requests
 
+from flow_tools import git_util
+from flow_tools import http_util
+
 class Configuration(object):
   def __init__(self, rest, ssh):
     self.rest = rest
@@ -10,58 +19,164 @@ class Configuration(object):
 
 def get_gerrit(url, username, password):
   """
-  Return a gerrit rest client object basedon the configuration.
+  Return a gerrit rest client object basedon the configuration. Requests that
+  fail with a gateway error are retried, over connections reused from a pool.
   """
   auth = requests.auth.HTTPDigestAuth(username, password)
-  return pygerrit2.rest.GerritRestAPI(url=url, auth=auth)
+  return pygerrit2.rest.GerritRestAPI(
+      url=url, auth=auth, adapter=http_util.get_retrying_adapter())
 
 
 def get_gerrit_change_id(commit):
   """Parse the commit message to get the gerrit change id."""
 
-  for line in commit.message.splitlines():
-    parts = line.strip().split(':', 1)
-    if len(parts) != 2:
-      continue
-    if parts[0] == 'Change-Id':
-      return parts[1].strip()
+  for match in git_util.TAG_RE.finditer(commit.message):
+    if match.group(1) == 'Change-Id':
+      return match.group(2)
 
   return None
 
 def gerrit_query(**filters):
   """
   Format a query string given gerrit query filters. The query string is composed
-  of ulr-encoded-space (i.e. '+') separated key:value pairs. The value will be
-  quoted if it contains whitespace like key:"value x".
+  of space separated key:value pairs. The value will be quoted if it contains
+  whitespace like key:"value x". The query string is not url-encoded.
   """
   pairs = []
   for key in sorted(filters.keys()):
-    value = urllib.quote_plus(filters[key])
-    if '+' in value:
+    value = filters[key]
+    if len(value.split()) > 1:
       pairs.append('{}:"{}"'.format(key, value))
     else:
       pairs.append('{}:{}'.format(key, value))
-  return '+'.join(pairs)
+  return ' '.join(pairs)
+
+
+# Number of changes requested per page when querying gerrit for changes
+CHANGES_PAGE_SIZE = 500
 
 
 def get_changes_from_range(gerrit_client, project, start_time, end_time,
-                           offset=0):
+                           offset=0, page_size=CHANGES_PAGE_SIZE):
   """
   Call out to the gerrit REST API to get a list of changes that were updated
-  in the time period for the given project.
+  in the time period for the given project. At most `page_size` changes are
+  returned, starting at `offset`.
   """
   search_query = gerrit_query(
       project=project, after=start_time, before=end_time)
 
-  query_string = urllib.urlencode([  # ('q', search_query),
-      ('o', 'CURRENT_REVISION'),
-      ('o', 'LABELS'),
-      ('o', 'DETAILED_LABELS'),
-      ('o', 'DETAILED_ACCOUNTS'),
-      ('start', offset)])
+  params = [('q', search_query),
+            ('o', 'CURRENT_REVISION'),
+            ('o', 'LABELS'),
+            ('o', 'DETAILED_LABELS'),
+            ('o', 'DETAILED_ACCOUNTS'),
+            ('n', page_size),
+            ('start', offset)]
+
+  return gerrit_client.get('/changes/', params=params)
+
+
+def get_update_cursor(changeinfo):
+  """
+  Return the time that a change was last updated, formatted for use in a
+  gerrit query. Gerrit reports times with nanosecond precision but only
+  accepts milliseconds in queries.
+  """
+  # "2013-02-21 11:16:36.775000000" -> "2013-02-21 11:16:36.775"
+  return changeinfo['updated'][:23]
 
-  return gerrit_client.get('/changes/?q={}&{}'
-                           .format(search_query, query_string))
+
+def iter_change_pages(gerrit_client, project, start_time, end_time):
+  """
+  Return a generator yielding pages (lists) of changes that were updated in
+  the time period for the given project. The next page is requested in the
+  background while the current page is consumed.
+
+  Gerrit returns the most recently updated changes first, so each page is
+  requested with the period ending at the update time of the last change of
+  the previous page, rather than by offset. Changes that were updated during
+  the sync then don't shift the pages and cause changes to be skipped or
+  repeated. Since the end of the period is inclusive, changes of the previous
+  page updated at exactly that time are dropped from the next page.
+  """
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    before = end_time
+    offset = 0
+    seen = set()
+    future = executor.submit(get_changes_from_range, gerrit_client, project,
+                             start_time, before, offset)
+    while future is not None:
+      response = future.result()
+      page = [changeinfo for changeinfo in response
+              if changeinfo['id'] not in seen]
+
+      if response and response[-1].get('_more_changes', False):
+        cursor = get_update_cursor(response[-1])
+        if cursor == before:
+          # The whole page was updated at the same time as the cursor, which
+          # therefore can't advance
+          offset += len(response)
+        else:
+          before = cursor
+          offset = 0
+          seen.clear()
+        seen.update(changeinfo['id'] for changeinfo in response
+                    if get_update_cursor(changeinfo) == before)
+        future = executor.submit(get_changes_from_range, gerrit_client,
+                                 project, start_time, before, offset)
+      else:
+        future = None
+
+      yield page
+
+
+# Maximum number of entries retained in the commit message metadata cache
+MESSAGE_META_CACHE_SIZE = 4096
+
+# Maps (change_id, revision) to the metadata parsed from the commit message of
+# that revision. Revisions are immutable so entries never go stale, we only
+# evict the oldest entries once the cache is full.
+_MESSAGE_META_CACHE = collections.OrderedDict()
+
+# Guards _MESSAGE_META_CACHE, which may be accessed from worker threads
+_MESSAGE_META_LOCK = threading.Lock()
+
+
+def load_message_meta_cache(cache_path):
+  """
+  Populate the commit message metadata cache from a file previously written
+  by `save_message_meta_cache`. A missing or unreadable file is ignored.
+  """
+  try:
+    with io.open(cache_path, 'rb') as infile:
+      cache = pickle.load(infile)
+    with _MESSAGE_META_LOCK:
+      _MESSAGE_META_CACHE.update(cache)
+  except (IOError, OSError):
+    pass
+  except (EOFError, pickle.UnpicklingError):
+    logging.warn('Ignoring corrupt message meta cache: %s', cache_path)
+
+
+def save_message_meta_cache(cache_path):
+  """
+  Write the commit message metadata cache to `cache_path` so that it can be
+  reused by later runs.
+  """
+  tmp_path = cache_path + '.tmp'
+  try:
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    with _MESSAGE_META_LOCK:
+      cache = collections.OrderedDict(_MESSAGE_META_CACHE)
+    with io.open(tmp_path, 'wb') as outfile:
+      pickle.dump(cache, outfile, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, cache_path)
+  except (IOError, OSError):
+    logging.warn('Failed to write message meta cache: %s', cache_path)
 
 
 def get_message_meta(gerrit_client, change_id, revision):
@@ -82,8 +197,17 @@ def get_message_meta(gerrit_client, change_id, revision):
   written more than once in the commit message and the contents will be
   merged. The contents are expected to be a comma separated list of strings.
   The output dictionary will contain the separated list of strings.
+
+  Results are cached per (change_id, revision) so that each revision is only
+  fetched from gerrit once.
   """
 
+  cache_key = (change_id, revision)
+  with _MESSAGE_META_LOCK:
+    result = _MESSAGE_META_CACHE.get(cache_key, None)
+  if result is not None:
+    return result
+
   parsed_details = gerrit_client.get('changes/{}/revisions/{}/commit'
                                      .format(change_id, revision))
 
@@ -91,15 +215,17 @@ def get_message_meta(gerrit_client, change_id, revision):
     raise RuntimeError('Message is not a field in returned json')
 
   result = dict(Closes=[], Resolves=[])
-  for line in parsed_details['message'].splitlines():
-    parts = line.split(':', 1)
-    if len(parts) == 2:
-      key, value = parts
-      if key in ['Feature-Branch', 'Base-Branch', 'Relative-To-Branch',
-                 'ChangeId']:
-        result[key] = value.strip()
-      elif key in ['Closes', 'Resolves']:
-        issues = [item.strip() for item in value.strip().split(',')]
-        result[key].extend(issues)
-
+  for match in git_util.TAG_RE.finditer(parsed_details['message']):
+    key, value = match.groups()
+    if key in ['Feature-Branch', 'Base-Branch', 'Relative-To-Branch',
+               'ChangeId']:
+      result[key] = value
+    elif key in ['Closes', 'Resolves']:
+      issues = [item for item in git_util.ISSUE_SEP_RE.split(value) if item]
+      result[key].extend(issues)
+
+  with _MESSAGE_META_LOCK:
+    _MESSAGE_META_CACHE[cache_key] = result
+    while len(_MESSAGE_META_CACHE) > MESSAGE_META_CACHE_SIZE:
+      _MESSAGE_META_CACHE.popitem(last=False)
   return result
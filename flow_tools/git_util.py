@@ -10,40 +10,42 @@ class Configuration(object):
     self.release_pattern = release_pattern
     self.release_key = release_key
 
-def resolve_merge_commit(commit):
+# Matches each "Key: value" metadata line of a commit message, capturing the
+# key and the value with surrounding whitespace removed
+TAG_RE = re.compile(r'(?m)^[ \t]*([A-Za-z][\w-]*)[ \t]*:[ \t]*(.*?)[ \t\r]*$')
+
+# Separates the items of a comma separated list of issues
+ISSUE_SEP_RE = re.compile(r'\s*,\s*')
+
+
+# Maps release patterns to their compiled regular expressions
+_RELEASE_RE_CACHE = {}
+
+
+def get_release_re(release_pattern):
   """
-  If commit was made by merge-queue, find the real owner and return that
-  commit.
+  Return the compiled regular expression for a release pattern
   """
-  try:
-    while commit.author.email.startswith(u'merge'):
-      commit = commit.parents[-1]
-    return commit
-  except:  # pylint:disable=bare-except
-    return None
+  release_re = _RELEASE_RE_CACHE.get(release_pattern, None)
+  if release_re is None:
+    release_re = re.compile(release_pattern)
+    _RELEASE_RE_CACHE[release_pattern] = release_re
+  return release_re
 
 
 def get_merge_commits(repo_path, branch='master'):
   """
   Return a generator yielding commits into master.
   """
-  repo = git.Repo(repo_path)
+  # Commit objects are loaded lazily through the object database. With
+  # GitCmdObjectDB all of them are read from one long-lived
+  # `git cat-file --batch` process rather than a git process per commit.
+  repo = git.Repo(repo_path, odbt=git.GitCmdObjectDB)
 
   # NOTE(josh): usually we would want --merges, but since skydio has a dumb
   # merge strategy we have to do this nonsense.
-  git_proc = subprocess.Popen(['git', 'log', '--no-merges', '--first-parent',
-                               '--format=%H', branch],
-                              cwd=repo_path,
-                              stdout=subprocess.PIPE)
-
-  for commit_hash in git_proc.stdout:
-    commit = repo.commit(commit_hash.strip())
-
-    if commit is not None:
-      yield commit
-
-  git_proc.stdout.close()
-  git_proc.wait()
+  for commit in repo.iter_commits(branch, no_merges=True, first_parent=True):
+    yield commit
 
 
 
@@ -55,25 +57,7 @@ def get_merges_that_close_issues(tag_map, repo_path, branch='master'):
   """
 
   for commit in get_merge_commits(repo_path, branch):
-    resolutions = {}
-    for line in commit.message.splitlines():
-      parts = line.strip().split(':', 1)
-      if len(parts) != 2:
-        continue
-      key, issues = parts
-
-      resolution = tag_map.get(key, None)
-      if resolution is None:
-        resolution = tag_map.get(key.lower(), None)
-        if resolution is None:
-          continue
-
-      for issue in issues.split(','):
-        issue = issue.strip()
-        if issue is None or issue == 'None':
-          continue
-        resolutions[issue.strip()] = resolution
-
+    resolutions = get_resolutions(commit.message, tag_map)
     if resolutions:
       yield commit, resolutions
 
@@ -86,14 +70,15 @@ def get_releases(repo_path, config):
   function from the config file.
   """
 
-  version_re = re.compile(config.git.release_pattern)
+  version_re = get_release_re(config.git.release_pattern)
   versions = []
   proc = subprocess.Popen(['git', '--git-dir', os.path.join(repo_path, '.git'),
-                           'tag'], stdout=subprocess.PIPE)
+                           'for-each-ref', '--format=%(refname:lstrip=2)',
+                           'refs/tags/'], stdout=subprocess.PIPE)
 
   with proc.stdout:
     for line in proc.stdout:
-      line = line.strip()
+      line = line.decode('utf-8').strip()
       if version_re.match(line):
         versions.append(line)
 
@@ -101,45 +86,98 @@ def get_releases(repo_path, config):
   return sorted(versions, key=config.git.release_key)
 
 
+# Maximum number of `git describe` calls made looking for the previous release
+# before falling back to listing every tag
+MAX_DESCRIBE_CALLS = 8
+
+# Characters with a special meaning in the glob of `git describe --exclude`,
+# which are escaped so that a tag only excludes itself
+GLOB_SPECIAL_RE = re.compile(r'([*?[\\])')
+
+
+def get_previous_release(repo_path, config, release):
+  """
+  Return the most recent tag matching the release pattern from the config file
+  that is a strict ancestor of `release`, or None if there is no such tag.
+  If too many other tags are closer than the previous release then the
+  release preceding `release` in the sorted list of all releases is returned
+  instead.
+  """
+
+  version_re = get_release_re(config.git.release_pattern)
+  command = ['git', '--git-dir', os.path.join(repo_path, '.git'),
+             'describe', '--tags', '--abbrev=0']
+  excludes = []
+  for _ in range(MAX_DESCRIBE_CALLS):
+    try:
+      tag = subprocess.check_output(
+          command + excludes + [release + '^'],
+          stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+      return None
+
+    if version_re.match(tag):
+      return tag
+
+    # Some other tag is closer, exclude it and look again
+    excludes.append('--exclude=' + GLOB_SPECIAL_RE.sub(r'\\\1', tag))
+
+  releases = get_releases(repo_path, config)
+  if release not in releases:
+    return None
+  idx = releases.index(release)
+  if idx == 0:
+    return None
+  return releases[idx - 1]
+
+
+def get_release_pair(repo_path, config, release):
+  """
+  Return a tuple (from_tag, to_tag) where to_tag is `release` and from_tag is
+  the release preceding it. This only inspects the ancestry of `release`
+  rather than parsing every tag in the repository. Returns None if `release`
+  doesn't match the release pattern or has no preceding release.
+  """
+
+  if not get_release_re(config.git.release_pattern).match(release):
+    return None
+
+  from_tag = get_previous_release(repo_path, config, release)
+  if from_tag is None:
+    return None
+  return from_tag, release
+
+
 def get_merges_in_series(repo_path, from_commit, to_commit):
   """
-  Return a generator over merge commits in the sequence from_commit..to_commit
+  Return a list of (sha, subject, message) tuples for the merge commits in the
+  sequence from_commit..to_commit. All commits are read from a single git log
+  invocation using NUL separated fields.
   """
 
   # NOTE(josh): usually we would want --merges, but since skydio has a dumb
   # merge strategy we have to do this nonsense.
-  git_proc = subprocess.Popen(
+  output = subprocess.check_output(
       ['git', '--git-dir', os.path.join(repo_path, '.git'),
-       'log', '--no-merges', '--first-parent', '--format=%H',
-       '{}...{}'.format(from_commit, to_commit)],
-      stdout=subprocess.PIPE)
-
-  with git_proc.stdout:
-    for commit_hash in git_proc.stdout:
-      commit_hash = commit_hash.strip()
-      yield commit_hash
+       'log', '-z', '--no-merges', '--first-parent',
+       '--format=%H%x00%s%x00%B',
+       '{}...{}'.format(from_commit, to_commit)])
 
-  git_proc.wait()
-  assert git_proc.returncode == 0, \
-    "Failed to log {}...{}".format(from_commit, to_commit)
+  # With -z each commit is terminated by a NUL, so the output is a flat
+  # sequence of NUL terminated (hash, subject, message) fields
+  fields = output.decode('utf-8', 'replace').split('\x00')
+  return list(zip(fields[0::3], fields[1::3], fields[2::3]))
 
 
-def get_resolutions(repo_path, commit, tag_map):
+def get_resolutions(message, tag_map):
   """
-  Return a dictionary of {issue-key : resolution} for issues closed in this
-  commit
+  Return a dictionary of {issue-key : resolution} for issues closed by the
+  commit with the given commit message
   """
 
-  message = subprocess.check_output(
-      ['git', '--git-dir', os.path.join(repo_path, '.git'),
-       'log', '--format=%B', '-n', '1', commit])
-
   resolutions = {}
-  for line in message.splitlines():
-    parts = line.strip().split(':', 1)
-    if len(parts) != 2:
-      continue
-    key, issues = parts
+  for match in TAG_RE.finditer(message):
+    key, issues = match.groups()
 
     resolution = tag_map.get(key, None)
     if resolution is None:
@@ -147,24 +185,29 @@ def get_resolutions(repo_path, commit, tag_map):
       if resolution is None:
         continue
 
-    for issue in issues.split(','):
-      issue = issue.strip()
-      if issue is None or issue == 'None':
+    for issue in ISSUE_SEP_RE.split(issues):
+      if not issue or issue == 'None':
         continue
       resolutions[issue] = resolution
 
   return resolutions
 
-def get_message_summary(repo_path, commit, maxlen=70):
+def get_message_summary(commit, subject, maxlen=70):
   """
-  Return the first line of the commit message
+  Return the first line of the commit message, prefixed by the abbreviated
+  commit hash
   """
   wrapper = textwrap.TextWrapper(width=maxlen, initial_indent='',
                                  subsequent_indent=' '*10)
-  summary = subprocess.check_output(
+  return '{}: {}'.format(commit[:8], wrapper.fill(subject.strip()))
+
+def get_merge_base(repo_path, from_tag, to_tag):
+  """
+  Return the hash of the common ancestor of two commits
+  """
+  return subprocess.check_output(
       ['git', '--git-dir', os.path.join(repo_path, '.git'),
-       'log', '--format=%s', '-n', '1', commit]).strip()
-  return '{}: {}'.format(commit[:8], wrapper.fill(summary))
+       'merge-base', from_tag, to_tag]).decode('utf-8').strip()
 
 def get_release_notes(repo_path, from_tag, to_tag):
   """
@@ -172,13 +215,12 @@ def get_release_notes(repo_path, from_tag, to_tag):
   versions
   """
 
-  merge_base = subprocess.check_output(['git', '--git-dir',
-                                        os.path.join(repo_path, '.git'),
-                                        'merge-base', from_tag, to_tag]).strip()
+  merge_base = get_merge_base(repo_path, from_tag, to_tag)
 
   summaries = []
-  for commit in get_merges_in_series(repo_path, merge_base, to_tag):
-    summaries.append(get_message_summary(repo_path, commit))
+  for commit, subject, _ in get_merges_in_series(repo_path, merge_base,
+                                                 to_tag):
+    summaries.append(get_message_summary(commit, subject))
 
   return summaries
 
@@ -187,12 +229,26 @@ def get_issues_closed_in_series(repo_path, from_tag, to_tag, tag_map):
   Return a list of issues that were closed between two consecutive versions
   identified with a git tag
   """
-  merge_base = subprocess.check_output(['git', '--git-dir',
-                                        os.path.join(repo_path, '.git'),
-                                        'merge-base', from_tag, to_tag]).strip()
+  merge_base = get_merge_base(repo_path, from_tag, to_tag)
   resolved_issues = []
-  for commit in get_merges_in_series(repo_path, merge_base, to_tag):
-    resolutions = get_resolutions(repo_path, commit, tag_map)
+  for _, _, message in get_merges_in_series(repo_path, merge_base, to_tag):
+    resolutions = get_resolutions(message, tag_map)
     resolved_issues.extend(resolutions.keys())
 
   return sorted(resolved_issues)
+
+def walk_release(repo_path, from_tag, to_tag, tag_map):
+  """
+  Return a tuple (issues, summaries) of the issues closed and the commit
+  message summaries between two consecutive versions, computed in a single
+  pass over the commits of the release
+  """
+  merge_base = get_merge_base(repo_path, from_tag, to_tag)
+  resolved_issues = []
+  summaries = []
+  for commit, subject, message in get_merges_in_series(repo_path, merge_base,
+                                                       to_tag):
+    resolved_issues.extend(get_resolutions(message, tag_map).keys())
+    summaries.append(get_message_summary(commit, subject))
+
+  return sorted(resolved_issues), summaries
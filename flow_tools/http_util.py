@@ -0,0 +1,39 @@
+"""
+Helpers for configuring the HTTP sessions used by the rest clients
+"""
+
+import requests
+from urllib3.util.retry import Retry
+
+
+def get_pooled_adapter(pool_maxsize=16, max_retries=0):
+  """
+  Return a transport adapter that keeps up to `pool_maxsize` connections per
+  host alive, so that sequential and concurrent requests reuse established
+  TCP/TLS connections.
+  """
+  return requests.adapters.HTTPAdapter(
+      pool_connections=4, pool_maxsize=pool_maxsize, max_retries=max_retries)
+
+
+def get_retrying_adapter(pool_maxsize=16):
+  """
+  Return a pooled transport adapter which also retries idempotent requests
+  that fail with a transient gateway error. Once the retries are exhausted the
+  last response is returned, rather than raising, so callers see the same
+  HTTP errors as without retries.
+  """
+  return get_pooled_adapter(
+      pool_maxsize,
+      Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+            raise_on_status=False))
+
+
+def mount_pooled_adapter(session, pool_maxsize=16):
+  """
+  Mount a pooled transport adapter, without retries, on `session`.
+  """
+  adapter = get_pooled_adapter(pool_maxsize)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
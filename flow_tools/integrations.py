@@ -6,7 +6,10 @@ Functions that perform integration tasks between one or more of:
   * A jira instance
 """
 
+import collections
+import concurrent.futures
 import datetime
+import itertools
 import logging
 import jira
 
@@ -47,32 +50,44 @@ def close_issues_with_merged_resolutions(jira_client, repo_path, tag_map,
      message tags marking issue resolutions. For each issue that is resolved,
      update it's status in jira."""
 
-  iter_count = 0
-  resolve_to = None
-  for jira_res in jira_client.resolutions():
-    if jira_res.name == 'Done':
-      resolve_to = jira_res
+  resolve_to = next((jira_res for jira_res
+                     in jira_util.get_resolutions(jira_client)
+                     if jira_res.name == 'Done'), None)
 
   assert resolve_to is not None
   resolve_to = dict(id=resolve_to.id)
 
-  for commit, resolutions in (
-      git_util.get_merges_that_close_issues(tag_map, repo_path, branch)):
-    for issue_key, resolution in resolutions.iteritems():
-      try:
-        issue = jira_client.issue(issue_key, 'status')
-      except jira.JIRAError:
+  merges = list(itertools.islice(
+      git_util.get_merges_that_close_issues(tag_map, repo_path, branch),
+      max_commits))
+
+  # Fetch all of the issues up front in as few requests as possible
+  issue_keys = set()
+  for _, resolutions in merges:
+    issue_keys.update(resolutions.keys())
+  issues = jira_util.get_issues(jira_client, issue_keys, 'status,issuetype')
+
+  # Status of issues that we've transitioned, which is newer than the status
+  # of the issue objects fetched above. Keyed by the issue's own key, since
+  # commit messages may name the same issue differently.
+  transitioned = {}
+
+  for commit, resolutions in merges:
+    for issue_key, resolution in resolutions.items():
+      issue = issues.get(issue_key, None)
+      if issue is None:
         continue
 
-      if issue.fields.status.name != resolution:
+      current_status = transitioned.get(issue.key, issue.fields.status.name)
+      if current_status != resolution:
         tid, available_states = jira_util.get_transition_to(
-            jira_client, issue, resolution)
+            jira_client, issue, resolution, current_status)
         if tid is None:
           logging.warn(
               'commit %s resolves issue %s as %s but I can find'
               ' no transition to that state. Available states: %s, current'
               ' state: %s', commit.hexsha, issue_key, resolution,
-              ','.join(sorted(available_states)), issue.fields.status.name)
+              ','.join(sorted(available_states)), current_status)
           continue
 
         logging.info('Resolving %s to %s using transition %s due to commit %s',
@@ -80,10 +95,7 @@ def close_issues_with_merged_resolutions(jira_client, repo_path, tag_map,
         jira_client.transition_issue(issue, tid, resolution=resolve_to)
         message = make_resolution_message(commit)
         jira_client.add_comment(issue, message)
-
-    iter_count += 1
-    if iter_count > max_commits:
-      break
+        transitioned[issue.key] = resolution
 
 
 def get_jira_status_from_changeinfo(changeinfo):
@@ -129,133 +141,289 @@ See: https://gerrit.skyd.io/#/q/{change_id}
 """.format(**fmtargs)
 
 
+def mark_revision_processed(sql, changeinfo, dry_run):
+  """
+  Record that the current revision of a change has been processed in its
+  current state. Nothing is recorded for a dry run, since the transitions of a
+  dry run are not actually performed. The record is committed along with the
+  rest of the session.
+  """
+  if dry_run:
+    return
+
+  sql.merge(orm.ProcessedRevision(changeid=changeinfo['change_id'],
+                                  revision=changeinfo['current_revision'],
+                                  status=changeinfo['status'],
+                                  processed_at=datetime.datetime.utcnow()))
+
+
+def get_change_resolutions(gerrit_client, changeinfo, tag_pairs):
+  """
+  Fetch the commit message metadata of a change and return a list of
+  (issue_key, resolution) tuples for each issue that the change resolves.
+  `tag_pairs` is a sequence of (tag, resolution) pairs for the tags to look
+  for.
+  """
+  change_meta = gerrit_util.get_message_meta(
+      gerrit_client, changeinfo['change_id'],
+      changeinfo['current_revision'])
+  return [(issue, resolution) for tag, resolution in tag_pairs
+          for issue in change_meta.get(tag, ())]
+
+
+def apply_transition(jira_client, changeinfo, issue, from_status, goal_state,
+                     resolve_to, resolved_states, dry_run):
+  """
+  Transition `issue` from `from_status` to `goal_state` and comment on the
+  issue with the change that caused the transition. `resolved_states` is the
+  set of states that an issue is resolved to, which require a resolution.
+
+  Returns a tuple (log_event, applied) where log_event is a GerritJiraTrans log
+  entry for the transition, or None if no transition was attempted, and
+  applied is true if jira accepted the transition.
+  """
+  tid, available_states = jira_util.get_transition_to(
+      jira_client, issue, goal_state, from_status)
+  if tid is None:
+    logging.info('  %s: missing transition, Available states: %s',
+                 issue.key, ','.join(sorted(available_states)))
+    return None, False
+
+  if dry_run:
+    logging.info('  %s: skipping transition: dry-run', issue.key)
+    return None, False
+
+  applied = True
+  message = make_jira_message(changeinfo, goal_state)
+  if goal_state in resolved_states:
+    try:
+      jira_client.transition_issue(issue, tid, resolution=resolve_to)
+      jira_client.add_comment(issue, message)
+    except jira.exceptions.JIRAError:
+      # NOTE(josh): for now, just ignore. This is the case of someone
+      # marking a change as `Closes` but then manually putting it to
+      # `Resolved`.
+      logging.warn('spoofing transition due to JIRA error')
+      applied = False
+  else:
+    jira_client.transition_issue(issue, tid)
+    jira_client.add_comment(issue, message)
+
+  log_event = orm.GerritJiraTrans(time=datetime.datetime.utcnow(),
+                                  issue=issue.key,
+                                  from_status=from_status,
+                                  to_status=goal_state)
+  return log_event, applied
+
+
 def update_issues_from_review(gerrit_client, jira_client, sql,
                               project, start_time, end_time, dry_run,
-                              nominal_flow, tag_map):
+                              nominal_flow, tag_map, max_workers=8,
+                              force=False):
   """
   Query gerrit for any changes which are modified in the time period specified,
   check any issues that are mapped to those changes through the commit messge,
   if the status of the change in gerrit suggests a status change of the issue
   then update that issue status to match.
+
+  Work is pipelined: pages of changes are fetched from gerrit in the
+  background, the gerrit requests and jira transitions for each page are
+  issued from a pool of `max_workers` threads, the issues of each page are
+  fetched from jira with batched searches, and the database is only accessed
+  from the calling thread.
+
+  A change is recorded as processed once nothing is left to do for the issues
+  it resolves, i.e. each was transitioned or is already at or past the goal
+  state, and is skipped until it gets a new revision or status. Changes with
+  an unknown issue, a missing or failed transition, or an issue with multiple
+  active changes are retried on the next sync. Pass `force` to process
+  recorded changes again, e.g. after the configuration or the jira workflow
+  changed.
   """
   # pylint: disable=too-many-statements
 
-  resolve_to = None
-  for jira_res in jira_client.resolutions():
-    if jira_res.name == 'Done':
-      resolve_to = jira_res
+  resolve_to = next((jira_res for jira_res
+                     in jira_util.get_resolutions(jira_client)
+                     if jira_res.name == 'Done'), None)
 
   assert resolve_to is not None
   resolve_to = dict(id=resolve_to.id)
 
-  offset = 0
-  has_more_changes = True
-  while has_more_changes:
-    response = gerrit_util.get_changes_from_range(
-        gerrit_client, project, start_time, end_time, offset)
-    for changeinfo in response:
-      print('{} : {}'.format(changeinfo.get('change_id', '??'),
-                             changeinfo.get('status', '??')))
-
-      if changeinfo['status'] == 'ABANDONED':
-        # Delete any database records for the abandoned change
-        (sql
-         .query(orm.GerritJira)
-         .filter_by(changeid=changeinfo['change_id'])
-         .delete())
-        continue
-
-      change_meta = gerrit_util.get_message_meta(
-          gerrit_client, changeinfo['change_id'],
-          changeinfo['current_revision'])
-      resolutions = []
-      for key in ['Closes', 'Resolves']:
-        for issue in change_meta[key]:
-          resolutions.append((issue, tag_map[key]))
-
-      for issue_key, resolution in resolutions:
-        try:
-          issue = jira_client.issue(issue_key, 'status')
-        except jira.JIRAError:
-          logging.warn('  %s: \n    not an issue', issue_key)
-          continue
-
-        # If we have not yet associated this change with this issue, than
-        # add an association.
-        if (sql
-            .query(orm.GerritJira)
-            .filter_by(issue=issue_key, changeid=changeinfo['change_id'])
-            .count()) == 0:
-          record = orm.GerritJira(issue=issue_key,
-                                  changeid=changeinfo['change_id'])
-          sql.add(record)
-          sql.commit()
-
-        if changeinfo['status'] == 'MERGED':
-          goal_state = resolution
-        # TODO(josh): or number of reviewers other than the owner and jenkins
-        # is zero
-        elif changeinfo['status'] == 'DRAFT':
-          goal_state = 'In Progress'
-        else:
-          goal_state = 'In Review'
-
-        logging.info('  %s: %s -> %s', issue_key, issue.fields.status.name,
-                     goal_state)
-
-        # If the change would be a backward movement in the nominal flow,
-        # then, don't advance it
-        if '-' not in issue.key:
-          logging.warn('    issue does not have a prefix: %s', issue_key)
-          continue
-
-        project_key = issue.key.split('-')[0]
-        if not jira_util.is_nominal_transition(
-            nominal_flow.get(project_key, {}),
-            issue.fields.status.name, goal_state):
-          logging.info('    skipping transition, non-forward flow')
-          continue
-
-        # If there is more than one change associated with the given issue,
-        # then disble transition
-        if sql.query(orm.GerritJira).filter_by(issue=issue_key).count() > 1:
-          logging.info('    skipping transition, multiple active commits')
+  tag_pairs = tuple((tag, tag_map[tag]) for tag in ('Closes', 'Resolves'))
+  resolved_states = frozenset(tag_map.values())
+
+  def fetch(changeinfo):
+    return get_change_resolutions(gerrit_client, changeinfo, tag_pairs)
+
+  def transition(queued):
+    # The transitions queued for one issue are applied in order, stopping at
+    # the first one that isn't made since the later ones were decided
+    # assuming that it would be. Returns the log events, the number of
+    # transitions applied, and the error that stopped them if any, so that
+    # the transitions made before an error are still recorded.
+    log_events = []
+    applied_count = 0
+    try:
+      for changeinfo, issue, from_status, goal_state in queued:
+        log_event, applied = apply_transition(
+            jira_client, changeinfo, issue, from_status, goal_state,
+            resolve_to, resolved_states, dry_run)
+        if log_event is not None:
+          log_events.append(log_event)
+        if not applied:
+          break
+        applied_count += 1
+    except Exception as err:  # pylint: disable=broad-except
+      return log_events, applied_count, err
+    return log_events, applied_count, None
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    for response in gerrit_util.iter_change_pages(
+        gerrit_client, project, start_time, end_time):
+      # Load the processed revisions of all changes in this page at once
+      processed_by_id = {}
+      if response and not force:
+        processed_by_id.update(
+            (processed.changeid, processed) for processed
+            in sql.query(orm.ProcessedRevision).filter(
+                orm.ProcessedRevision.changeid.in_(
+                    [changeinfo['change_id'] for changeinfo in response])))
+
+      changes = []
+      abandoned_ids = []
+      for changeinfo in response:
+        logging.info('%s : %s', changeinfo.get('change_id', '??'),
+                     changeinfo.get('status', '??'))
+
+        # If we've already processed this revision of the change, and its
+        # status hasn't changed since, then there is nothing new to do
+        processed = processed_by_id.get(changeinfo['change_id'], None)
+        if (processed is not None
+            and processed.revision == changeinfo['current_revision']
+            and processed.status == changeinfo['status']):
+          logging.info('  skipping change, revision already processed')
           continue
 
-        tid, available_states = jira_util.get_transition_to(
-            jira_client, issue, goal_state)
-        if tid is None:
-          logging.info('    missing transition, Available states: {}'
-                       .format(','.join(sorted(available_states))))
+        if changeinfo['status'] == 'ABANDONED':
+          abandoned_ids.append(changeinfo['change_id'])
+          mark_revision_processed(sql, changeinfo, dry_run)
           continue
 
-        if dry_run:
-          logging.info('    skipping transition: dry-run')
-          continue
+        changes.append(changeinfo)
 
-        message = make_jira_message(changeinfo, goal_state)
-        if goal_state in tag_map.values():
-          try:
-            jira_client.transition_issue(issue, tid, resolution=resolve_to)
-            jira_client.add_comment(issue, message)
-          except jira.exceptions.JIRAError:
-            # NOTE(josh): for now, just ignore. This is the case of someone
-            # marking a change as `Closes` but then manually putting it to
-            # `Resolved`.
-            logging.warn('spoofing transition due to JIRA error')
-        else:
-          jira_client.transition_issue(issue, tid)
-          jira_client.add_comment(issue, message)
-
-        log_event = orm.GerritJiraTrans(time=datetime.datetime.utcnow(),
-                                        issue=issue_key,
-                                        from_status=issue.fields.status.name,
-                                        to_status=goal_state)
-        sql.add(log_event)
-        sql.commit()
-
-    if len(response) > 0 and response[-1].get('_more_changes', False):
-      has_more_changes = True
-      offset += len(response)
-    else:
-      has_more_changes = False
+      # Delete any database records for the abandoned changes
+      if abandoned_ids:
+        (sql
+         .query(orm.GerritJira)
+         .filter(orm.GerritJira.changeid.in_(abandoned_ids))
+         .delete(synchronize_session=False))
+
+      page_resolutions = list(executor.map(fetch, changes))
+
+      # Fetch all issues resolved by changes in this page at once
+      issue_keys = set()
+      for resolutions in page_resolutions:
+        issue_keys.update(issue_key for issue_key, _ in resolutions)
+      issues_by_key = jira_util.get_issues(jira_client, issue_keys,
+                                           'status,issuetype')
+
+      # Load existing associations for all issues in this page at once
+      assoc_set = set()
+      if issue_keys:
+        assoc_set.update(sql
+                         .query(orm.GerritJira.issue, orm.GerritJira.changeid)
+                         .filter(orm.GerritJira.issue.in_(issue_keys)))
+      issue_count = collections.Counter(issue for issue, _ in assoc_set)
+
+      # Decide on the transition for each issue in page order, since the
+      # decision depends on associations recorded for earlier changes, and on
+      # the status that earlier transitions of the page leave an issue in.
+      # Transitions are queued per issue, so that those of different issues
+      # run concurrently but those of one issue run in order. Both are keyed
+      # by issue.key, since changes may name the same issue differently.
+      # Database records are buffered and written once per page.
+      new_assocs = []
+      new_logs = []
+      transitions = collections.OrderedDict()
+      decided_status = {}
+      # Ids of changes with an outcome that may change on a later sync
+      retry_ids = set()
+      for changeinfo, resolutions in zip(changes, page_resolutions):
+        status = changeinfo['status']
+        change_id = changeinfo['change_id']
+        for issue_key, resolution in resolutions:
+          issue = issues_by_key.get(issue_key, None)
+          if issue is None:
+            logging.warn('  %s: \n    not an issue', issue_key)
+            retry_ids.add(change_id)
+            continue
+
+          # If we have not yet associated this change with this issue, than
+          # add an association.
+          if (issue_key, change_id) not in assoc_set:
+            new_assocs.append(orm.GerritJira(issue=issue_key,
+                                             changeid=change_id))
+            assoc_set.add((issue_key, change_id))
+            issue_count[issue_key] += 1
+
+          if status == 'MERGED':
+            goal_state = resolution
+          # TODO(josh): or number of reviewers other than the owner and
+          # jenkins is zero
+          elif status == 'DRAFT':
+            goal_state = 'In Progress'
+          else:
+            goal_state = 'In Review'
+
+          current_status = decided_status.get(issue.key,
+                                              issue.fields.status.name)
+          logging.info('  %s: %s -> %s', issue_key, current_status, goal_state)
+
+          # If the change would be a backward movement in the nominal flow,
+          # then, don't advance it
+          project_key, sep, _ = issue.key.partition('-')
+          if not sep:
+            logging.warn('    issue does not have a prefix: %s', issue_key)
+            retry_ids.add(change_id)
+            continue
+
+          if not jira_util.is_nominal_transition(
+              nominal_flow.get(project_key, {}), current_status, goal_state):
+            logging.info('    skipping transition, non-forward flow')
+            continue
+
+          # If there is more than one change associated with the given issue,
+          # then disble transition
+          if issue_count[issue_key] > 1:
+            logging.info('    skipping transition, multiple active commits')
+            retry_ids.add(change_id)
+            continue
+
+          transitions.setdefault(issue.key, []).append(
+              (changeinfo, issue, current_status, goal_state))
+          decided_status[issue.key] = goal_state
+
+      error = None
+      queues = list(transitions.values())
+      for queued, (log_events, applied_count, err) in zip(
+          queues, executor.map(transition, queues)):
+        new_logs.extend(log_events)
+        retry_ids.update(changeinfo['change_id']
+                         for changeinfo, _, _, _ in queued[applied_count:])
+        if error is None:
+          error = err
+
+      sql.bulk_save_objects(new_assocs)
+      sql.bulk_save_objects(new_logs)
+
+      # Only record changes for which there is nothing left to do, so that
+      # the others are retried on the next sync
+      for changeinfo in changes:
+        if changeinfo['change_id'] not in retry_ids:
+          mark_revision_processed(sql, changeinfo, dry_run)
+      sql.commit()
+
+      # Raise the first failed transition only once the transitions that
+      # jira did accept have been recorded
+      if error is not None:
+        raise error
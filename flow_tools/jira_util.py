@@ -2,11 +2,16 @@
 Functions for communicating with a jira instance
 """
 
+import collections
 import logging
 import re
+import threading
+import time
 
 import jira
 
+from flow_tools import http_util
+
 class AuthConfig(object):
   def __init__(self, url, username, password):
     self.url = url
@@ -21,55 +26,181 @@ class Configuration(object):
 
 def get_jira(url, username, password, **_):
   """
-  Return a jira rest client object based on the configuration.
+  Return a jira rest client object based on the configuration. The session's
+  connection pool is enlarged so that worker threads sharing the client each
+  keep a connection open. Retries are left to jira's own ResilientSession.
   """
-  return jira.JIRA(url, basic_auth=(username, password))
+  jira_client = jira.JIRA(url, basic_auth=(username, password))
+  # pylint: disable=protected-access
+  http_util.mount_pooled_adapter(jira_client._session)
+  return jira_client
+
 
+# HTTP status code returned by jira when a client is being rate limited
+RATE_LIMITED_STATUS = 429
 
-def get_transition_to(jira_client, issue, target_state):
+
+def get_issue(jira_client, issue_key, fields=None, max_tries=5, backoff=0.5):
   """
-  Query jira to find a list of available transitions. Match the end state name
-  of those transitions against the string `target_state`. Return the transition
-  id that reaches the target state if found, or None if not.
+  Fetch an issue from jira. If jira responds that we are being rate limited
+  then retry, doubling the delay between each attempt.
+  """
+  delay = backoff
+  for _ in range(max_tries - 1):
+    try:
+      return jira_client.issue(issue_key, fields)
+    except jira.JIRAError as err:
+      if err.status_code != RATE_LIMITED_STATUS:
+        raise
+    logging.info('Rate limited fetching %s, retrying in %.1fs', issue_key,
+                 delay)
+    time.sleep(delay)
+    delay *= 2
 
-  Returns a tuple (tid, available_states)
+  return jira_client.issue(issue_key, fields)
+
+
+# Maximum number of issues requested by a single jira search
+SEARCH_BATCH_SIZE = 50
+
+
+def get_issues(jira_client, issue_keys, fields=None,
+               batch_size=SEARCH_BATCH_SIZE):
   """
+  Fetch many issues at once using a JQL search for each batch of
+  `batch_size` keys. Returns a dictionary mapping each issue key, as it was
+  requested, to its issue object. Keys which do not name an existing issue are
+  missing from the result.
+
+  The search returns issues under their canonical key, so results are matched
+  back to the requested keys ignoring case. Requested keys that are still
+  unmatched, such as the old key of a moved issue, are fetched individually.
+  """
+  issue_keys = sorted(set(issue_keys))
+  issues = {}
+  for idx in range(0, len(issue_keys), batch_size):
+    batch = issue_keys[idx:idx + batch_size]
+    query = 'key in ({})'.format(
+        ','.join('"{}"'.format(key.replace('"', '\\"')) for key in batch))
+    try:
+      results = jira_client.search_issues(query, fields=fields,
+                                          maxResults=len(batch),
+                                          validate_query=False)
+    except jira.JIRAError:
+      # The search as a whole failed, so fall back to fetching the issues of
+      # this batch one at a time.
+      logging.warn('Failed to search for issues, fetching individually')
+      results = []
+
+    requested = collections.defaultdict(list)
+    for key in batch:
+      requested[key.upper()].append(key)
+    for issue in results:
+      for key in requested.pop(issue.key.upper(), ()):
+        issues[key] = issue
+
+    for keys in requested.values():
+      for key in keys:
+        try:
+          issues[key] = get_issue(jira_client, key, fields)
+        except jira.JIRAError:
+          continue
+
+  return issues
+
+
+# Resolutions known to each jira client, keyed by id(jira_client)
+_RESOLUTIONS_CACHE = {}
+
+# Parsed transitions available from each workflow state, keyed by
+# (id(jira_client), project key, issue type, status name)
+_TRANSITIONS_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def get_resolutions(jira_client):
+  """
+  Return the list of resolutions known to jira. Resolutions are global to the
+  jira instance so they are only fetched once per client.
+  """
+  key = id(jira_client)
+  with _CACHE_LOCK:
+    resolutions = _RESOLUTIONS_CACHE.get(key, None)
+  if resolutions is None:
+    resolutions = jira_client.resolutions()
+    with _CACHE_LOCK:
+      _RESOLUTIONS_CACHE[key] = resolutions
+  return resolutions
+
 
-  tid = None
-  available_states = []
+# NOTE(josh): OMG,WTF,jira appears to have changed their output from
+# <from_state> : <to_state>
+# to
+# <from_state> -> <to_state>
+TRANSITION_NAME_RE = re.compile(r'\s*(?::|->)\s*')
+
+
+def get_transition_states(jira_client, issue, status=None):
+  """
+  Return a list of (to_state, tid) tuples for the transitions available to
+  `issue`. The transitions depend only on the workflow state of the issue, so
+  they are fetched and parsed once for each (project, issue type, status).
+  `status` is the current status of the issue, if it is newer than that of the
+  issue object.
+  """
+  if status is None:
+    status = issue.fields.status.name
+  issuetype = getattr(issue.fields, 'issuetype', None)
+  key = (id(jira_client), issue.key.split('-')[0],
+         None if issuetype is None else issuetype.name, status)
+  with _CACHE_LOCK:
+    states = _TRANSITIONS_CACHE.get(key, None)
+  if states is not None:
+    return states
+
+  states = []
   for transition in jira_client.transitions(issue):
-    # NOTE(josh): OMG,WTF,jira appears to have changed their output from
-    # <from_state> : <to_state>
-    # to
-    # <from_state> -> <to_state>
-    if ':' in transition['name']:
-      tstate = transition['name'].split(':', 1)[1].strip()
-    elif '->' in transition['name']:
-      tstate = transition['name'].split('->', 1)[1].strip()
-    else:
+    parts = TRANSITION_NAME_RE.split(transition['name'], 1)
+    if len(parts) != 2:
       logging.warn("Expected ':' or '->' in %s", transition['name'])
       continue
+    states.append((parts[1].strip(), transition['id']))
 
-    available_states.append(tstate)
-    if tstate == target_state:
-      tid = transition['id']
+  with _CACHE_LOCK:
+    _TRANSITIONS_CACHE[key] = states
+  return states
 
-  return tid, available_states
+
+def get_transition_to(jira_client, issue, target_state, status=None):
+  """
+  Query jira to find a list of available transitions. Match the end state name
+  of those transitions against the string `target_state`. Return the transition
+  id that reaches the target state if found, or None if not.
+
+  Returns a tuple (tid, available_states)
+  """
+  states = get_transition_states(jira_client, issue, status)
+  tid = next((tid for tstate, tid in states if tstate == target_state), None)
+  return tid, [tstate for tstate, _ in states]
 
 
 USER_RE = re.compile(r"\[~(?P<user>[^\]]+)\]")
 
-def get_mentioned_user_set(jira_client, issue):
-  """Return a set of users mentioned in the issue description or comments."""
+def get_mentioned_user_set(jira_client, issue, comments=None):
+  """
+  Return a set of users mentioned in the issue description or comments. The
+  comments are fetched from jira unless they are given in `comments`.
+  """
+  if comments is None:
+    comments = jira_client.comments(issue)
+
   user_set = set()
 
   if issue.fields.description is not None:
-    for user in USER_RE.findall(issue.fields.description):
-      user_set.add(user)
+    user_set.update(USER_RE.findall(issue.fields.description))
 
-  for comment in jira_client.comments(issue):
-    for user in USER_RE.findall(comment.body):
-      user_set.add(user)
+  for comment in comments:
+    user_set.update(USER_RE.findall(comment.body))
 
   return user_set
 
@@ -85,20 +216,20 @@ def get_watcher_user_set(jira_client, issue):
   return user_set
 
 
-def get_nonwatcher_mentions(jira_client, issue):
+def get_nonwatcher_mentions(jira_client, issue, comments=None):
   """Get a list of users mentioned in comments that are not watchers."""
 
-  mention_set = get_mentioned_user_set(jira_client, issue)
+  mention_set = get_mentioned_user_set(jira_client, issue, comments)
   watcher_set = get_watcher_user_set(jira_client, issue)
 
   return mention_set.difference(watcher_set)
 
 
-def add_mentions_to_watchers(jira_client, issue):
+def add_mentions_to_watchers(jira_client, issue, comments=None):
   """Add users mentioned in comments to watcher list"""
 
   logging.info("Adding watchers to %s", issue.key)
-  for user in get_nonwatcher_mentions(jira_client, issue):
+  for user in get_nonwatcher_mentions(jira_client, issue, comments):
     logging.info("  %s", user)
     jira_client.add_watcher(issue, user)
 
@@ -8,6 +8,7 @@ from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import UniqueConstraint
 
 # A sqlalchemy concept, a kind of 'registry' of the SQL object mapping
@@ -20,7 +21,9 @@ class GerritJira(Base):  # pylint: disable=no-init
   """
 
   __tablename__ = 'gerrit_jira_map'
-  __table_args__ = (UniqueConstraint('changeid', 'issue', name='u_map'),
+  # issue comes first so that the constraint's index also serves
+  # lookups by issue alone
+  __table_args__ = (UniqueConstraint('issue', 'changeid', name='u_map'),
                     {'sqlite_autoincrement': True})
 
   rid = Column(Integer, primary_key=True)
@@ -42,7 +45,8 @@ class GerritJiraTrans(Base):  # pylint: disable=no-init
   """
 
   __tablename__ = 'gerrit_jira_log'
-  __table_args__ = {'sqlite_autoincrement': True}
+  __table_args__ = (Index('ix_gj_log_issue', 'issue'),
+                    {'sqlite_autoincrement': True})
 
   rid = Column(Integer, primary_key=True)
 
@@ -84,7 +88,69 @@ class PollHistory(Base): # pylint: disable=no-init
   status = Column(Integer)
 
 
+class ProcessedRevision(Base):  # pylint: disable=no-init
+  """
+  Stores the most recent revision and status of each gerrit change that we've
+  processed, so that unchanged changes can be skipped on subsequent polls.
+  """
+
+  __tablename__ = 'processed_revision'
+
+  # The gerrit change id.
+  changeid = Column(String, primary_key=True)
+
+  # The current revision of the change when it was processed
+  revision = Column(String)
+
+  # The gerrit status of the change when it was processed
+  status = Column(String)
+
+  # When we processed the change
+  processed_at = Column(DateTime)
 
+  def __repr__(self):
+    return ('<ProcessedRevision(changeid="{}", revision="{}", status="{}")>'
+            .format(self.changeid, self.revision, self.status))
+
+
+
+
+
+def create_missing_indexes(engine):
+  """
+  Create indexes which are missing from databases created by older versions.
+  create_all() only creates indexes along with their table, so they are not
+  added to tables that already exist.
+  """
+  with engine.begin() as connection:
+    for index in GerritJiraTrans.__table__.indexes:
+      index.create(connection, checkfirst=True)
+
+    # Older databases have u_map ordered as (changeid, issue), which doesn't
+    # help lookups by issue
+    inspector = sqlalchemy.inspect(connection)
+    for constraint in inspector.get_unique_constraints('gerrit_jira_map'):
+      if constraint['column_names'][0] != 'issue':
+        # Index the reflected table, so that the index isn't added to the
+        # model and created by create_all() for new databases
+        table = sqlalchemy.Table('gerrit_jira_map', sqlalchemy.MetaData(),
+                                 autoload_with=connection)
+        Index('ix_gj_issue', table.c.issue, table.c.changeid).create(
+            connection, checkfirst=True)
+
+
+def set_sqlite_pragmas(dbapi_connection, _):
+  """
+  Tune a new sqlite connection for many small write transactions. With a write
+  ahead log and synchronous=NORMAL a commit no longer waits on an fsync, at
+  the cost of possibly losing the last transactions if the machine crashes.
+  """
+  cursor = dbapi_connection.cursor()
+  cursor.execute('PRAGMA journal_mode=WAL')
+  cursor.execute('PRAGMA synchronous=NORMAL')
+  cursor.execute('PRAGMA temp_store=MEMORY')
+  cursor.execute('PRAGMA cache_size=-64000')
+  cursor.close()
 
 
 def init_sql(database_url):
@@ -93,8 +159,11 @@ def init_sql(database_url):
   """
 
   engine = sqlalchemy.create_engine(database_url, echo=False)
+  if engine.dialect.name == 'sqlite':
+    sqlalchemy.event.listen(engine, 'connect', set_sqlite_pragmas)
   try:
     Base.metadata.create_all(engine)
+    create_missing_indexes(engine)
   except:
     sys.stderr.write('database_url: {}\n'.format(database_url))
     raise
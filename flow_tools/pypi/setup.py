@@ -30,8 +30,8 @@ setup(
     entry_points={
         'console_scripts': ['flow-tools=flow_tools.__main__:main'],
     },
+    python_requires='>=3.7',
     install_requires=[
-        'enum34',
         'gitpython',
         'jira',
         'pygerrit2',